@@ -1,18 +1,41 @@
 import csv
 import json
 import re
+import time
+import random
 import logging
 from datetime import datetime
 from math import ceil
 
 import aerospike
+from aerospike import predicates
+from aerospike_helpers import expressions as exp
 from dateutil import parser as date_parser
 
+from dbq.utils import AdaptiveBatchSize, LogThrottle, RateLimiter, ResultSet, WatermarkStore, sample_estimate
+
 
 logger = logging.getLogger('as_query')
 
+# server error codes returned when the cluster sheds load
+# 18: device overload, 151: batch max requests exceeded, 152: batch queues full
+REJECTION_ERROR_CODES = (18, 151, 152)
+
+PARTITIONS = 4096
+
+INT64_MIN = -2 ** 63
+INT64_MAX = 2 ** 63 - 1
+
+# secondary indexes per (connection, namespace), refreshed after SINDEX_CACHE_TTL seconds
+SINDEX_CACHE_TTL = 300
+_sindex_cache = {}
+
 
 class ObjectManager(object):
+    # bounds and target latency (in seconds) for get(adaptive=True)
+    adaptive_batch_bounds = (500, 20000)
+    adaptive_target_latency = 1.0
+
     def __init__(self, connection, namespace, set, scan_options=None):
         self.namespace = namespace
         self.set = set
@@ -20,6 +43,11 @@ class ObjectManager(object):
         self._select_keys = []
         self._filter_kwargs = {}
         self._exclude_kwargs = {}
+        self._watermark_store = None
+        self._watermark_lag = 0
+        self._compact = False
+        self._adaptive = False
+        self._adaptive_batch = None
         self.scan_options = {
             'concurrent': True,
             'priority': aerospike.SCAN_PRIORITY_LOW
@@ -39,6 +67,30 @@ class ObjectManager(object):
         self._exclude_kwargs = kwargs
         return self
 
+    @property
+    def adaptive_stats(self):
+        """
+        Current batch size and counters of the adaptive controller (requests,
+        timeouts, rejections, increases, decreases, total_latency), None if
+        get(adaptive=True) was never called
+        """
+        if self._adaptive_batch is None:
+            return None
+        return self._adaptive_batch.to_dict()
+
+    def incremental(self, watermark_path, lag=300):
+        """
+        Makes scan() return only the records updated since the last
+        successful incremental scan of this namespace/set, the watermark
+        (record last-update-time in nanoseconds) is kept in watermark_path.
+        The watermark is set `lag` seconds before the scan start to cover the
+        clock skew between this host and the cluster, records updated in that
+        window are returned again by the next run
+        """
+        self._watermark_store = WatermarkStore(watermark_path)
+        self._watermark_lag = lag
+        return self
+
     def select(self, *args, **kwargs):
 
         if 'pk' in args:
@@ -47,10 +99,25 @@ class ObjectManager(object):
         self._select_keys = args
         return self
 
-    def get(self, pks=None, pk_file=None, save_file=None, save_format='json', batch_size=5000):
+    def get(self, pks=None, pk_file=None, save_file=None, save_format='json', batch_size=5000,
+            records_per_second=None, adaptive=False, compact=False):
         self._save_file = save_file
         self._save_format = save_format
         self._batch_size = batch_size
+        self._set_compact(compact)
+        self._rate_limiter = RateLimiter(records_per_second)
+        self._adaptive = adaptive
+        if adaptive:
+            # kept across get() calls, the learned size carries over
+            if self._adaptive_batch is None:
+                self._adaptive_batch = AdaptiveBatchSize(
+                    batch_size,
+                    *self.adaptive_batch_bounds,
+                    target_latency=self.adaptive_target_latency,
+                    name='as_query batch_size',
+                    logger=logger
+                )
+            self._batch_size = self._adaptive_batch.size
 
         if pks and pk_file:
             raise AssertionError('Only one of pks or pk_file is required')
@@ -59,7 +126,8 @@ class ObjectManager(object):
             self._save_records([], False)
 
         if pks:
-            return self._get_from_pks_list(pks)
+            # header (if any) is already written, so chunks are appended
+            return self._get_from_pks_list(pks, True)
         elif pk_file:
             return self._get_from_pk_file(pk_file)
         else:
@@ -69,38 +137,59 @@ class ObjectManager(object):
         if not isinstance(pks, list):
             raise AssertionError('params pks: should be a list of pks')
 
-        records = []
-
         if len(pks) > self._batch_size:
+            # batch size may change between chunks in adaptive mode
+            records = self._new_records()
             i = 0
-            while True:
-                chunk = pks[i * self._batch_size:(i + 1) * self._batch_size]
-                if not chunk:
-                    break
-                records += self._get_from_pks_list(chunk, append_mode)
-                i += 1
+            while i < len(pks):
+                chunk = pks[i:i + self._batch_size]
+                records.extend(self._get_from_pks_list(chunk, append_mode))
+                i += len(chunk)
             return records
 
         keys = []
         for each in pks:
             keys.append((self.namespace, self.set, each))
 
-        query_bins = self._query_bins()
-        if query_bins:
-            records = self.connection.select_many(keys, list(query_bins), self.get_policy)
-        else:
-            records = self.connection.get_many(keys, self.get_policy)
+        self._rate_limiter.acquire(len(keys))
 
-        filtered_records = []
+        try:
+            start = time.time()
+            records = self._get_many(keys)
+        except aerospike.exception.AerospikeError as e:
+            if isinstance(e, aerospike.exception.TimeoutError):
+                reason = 'timeout'
+            elif getattr(e, 'code', None) in REJECTION_ERROR_CODES:
+                reason = 'rejected'
+            else:
+                raise e
+
+            if not self._adaptive or not self._adaptive_batch.failure(reason):
+                raise e
+
+            # retry the same pks with the reduced batch size
+            self._batch_size = self._adaptive_batch.size
+            return self._get_from_pks_list(pks, append_mode)
+
+        if self._adaptive:
+            self._adaptive_batch.success(time.time() - start, len(keys))
+            self._batch_size = self._adaptive_batch.size
+
+        filtered_records = self._new_records()
         for r in records:
             if self._is_valid_record(r):
-                bins = self._get_bins(self._select_keys, r)
-                filtered_records.append(bins)
+                filtered_records.append(self._get_record(r))
 
         if self._save_file:
             self._save_records(filtered_records, append_mode)
         return filtered_records
 
+    def _get_many(self, keys):
+        query_bins = self._query_bins()
+        if query_bins:
+            return self.connection.select_many(keys, list(query_bins), self.get_policy)
+        return self.connection.get_many(keys, self.get_policy)
+
     def _get_from_pk_file(self, pk_file):
 
         if not self._save_file:
@@ -112,7 +201,7 @@ class ObjectManager(object):
                     # Accepted pk format: any string with ['alphabets', '.', '@', '-']
                     for pk in re.findall(r'[\w@.-]+', line):
                         pks.append(pk)
-                        if len(pks) > self._batch_size:
+                        if len(pks) >= self._batch_size:
                             self._get_from_pks_list(pks, True)
                             pks = []
 
@@ -120,36 +209,113 @@ class ObjectManager(object):
                 if pks:
                     self._get_from_pks_list(pks, True)
 
-    def scan(self, max_records_count=20, max_scans_count=100000, save_file=None, save_format='json', scan_option=None):
+    def scan(self, max_records_count=20, max_scans_count=100000, save_file=None, save_format='json', scan_option=None,
+             records_per_second=None, partition_filter=None, sample_percent=None, seed=None, use_index=True,
+             compact=False):
+        """
+        When one of the filters is an equality or a range on an indexed bin the
+        set is queried through the secondary index instead of scanned, the
+        other filters are applied on the returned records, see explain().
+
+        With sample_percent only a random contiguous range of partitions
+        covering sample_percent of the set is scanned (records are spread over
+        partitions by digest, so the range is a uniform sample), max_scans_count
+        is ignored and a dict with the (at most max_records_count) records and
+        the estimated totals is returned, see dbq.utils.sample_estimate
+
+        With compact the records are returned as a dbq.utils.ResultSet of
+        tuples instead of a list of dicts
+        """
 
         self._save_file = save_file
         self._save_format = save_format
-
-        if (max_scans_count == -1 or max_records_count > 100000) and not self._save_file:
+        self._set_compact(compact)
+
+        if sample_percent:
+            if self._watermark_store:
+                raise AssertionError('incremental scan can not be sampled')
+            if partition_filter:
+                raise AssertionError('partition_filter can not be used with sample_percent')
+            if not 0 < sample_percent <= 100:
+                raise AssertionError('sample_percent should be in (0, 100]')
+
+            # the seed is returned with the estimate, so the sample can be repeated
+            if seed is None:
+                seed = random.randint(0, 2 ** 31 - 1)
+
+            partition_count = max(1, int(round(PARTITIONS * sample_percent / 100.0)))
+            begin = random.Random(seed).randrange(PARTITIONS - partition_count + 1)
+            partition_filter = {'begin': begin, 'count': partition_count}
+            max_scans_count = -1
+            logger.info('Sampling partitions %s-%s of %s.%s', begin, begin + partition_count - 1,
+                        self.namespace, self.set)
+
+        # the watermark can only advance once every changed record was scanned
+        if self._watermark_store and (max_records_count != -1 or max_scans_count != -1 or partition_filter):
+            raise AssertionError('incremental scan requires a full scan: max_records_count=-1, max_scans_count=-1')
+
+        # a sample still scans every record it covers, only max_records_count bounds the result
+        if sample_percent and max_records_count == -1 and not self._save_file:
+            raise AssertionError('Save file is required for max_records_count -1')
+
+        if (max_scans_count == -1 and not sample_percent or max_records_count > 100000) and not self._save_file:
             raise AssertionError('Save file is required for max_records_count greater than 100000')
 
         if self._save_file:
             self._save_records([], False)
 
-        scanner = self.connection.scan(self.namespace, self.set)
-
-        query_bins = self._query_bins()
-        if query_bins:
-            scanner.select(*list(query_bins))
+        # partition scans (shards, samples) always scan
+        plan = self._plan(use_index and not partition_filter)
 
         scan_option = scan_option or self.scan_options
 
-        filtered_records = []
-        scanner.foreach(
-            self._scan_callback(filtered_records, max_records_count, max_scans_count),
-            options=scan_option
-        )
+        # throttling and partition sharding are both handled server side
+        scan_policy = {}
+        if records_per_second:
+            scan_policy['records_per_second'] = records_per_second
+        if partition_filter:
+            scan_policy['partition_filter'] = partition_filter
+
+        if self._watermark_store:
+            # records updated while scanning are picked again by the next run
+            watermark_key = 'as:{}.{}'.format(self.namespace, self.set)
+            next_watermark = int((time.time() - self._watermark_lag) * 10 ** 9)
+            watermark = self._watermark_store.get(watermark_key)
+            if watermark is not None:
+                # filtered on the server, unchanged records are not sent back
+                scan_policy['expressions'] = exp.GT(exp.LastUpdateTime(), watermark).compile()
+            logger.info('Incremental scan of %s.%s since %s', self.namespace, self.set, watermark)
+
+        filtered_records = self._new_records()
+        current_count = [0, 0]
+        callback_args = (filtered_records, max_records_count, max_scans_count, current_count, bool(sample_percent))
+        try:
+            self._execute_plan(plan, callback_args, scan_policy, scan_option)
+        except aerospike.exception.IndexNotFound:
+            if plan['type'] != 'query' or current_count[0]:
+                raise
+
+            # index dropped since it was cached
+            logger.warning('Index %s not found, falling back to a full scan', plan['index'])
+            _sindex_cache.pop((id(self.connection), self.namespace), None)
+            plan = self._plan(False)
+            self._execute_plan(plan, callback_args, scan_policy, scan_option)
 
         if self._save_file and filtered_records:
             # As _scan_callback saves in batches, there can few filtered result
             # which are not saved to file
             self._save_records(filtered_records, True)
             filtered_records = None
+
+        logger.info('Scan finished, Total Scanned: %s, Records Found: %s', current_count[0], current_count[1])
+
+        if self._watermark_store:
+            self._watermark_store.set(watermark_key, next_watermark)
+
+        if sample_percent:
+            estimate = sample_estimate(current_count[0], current_count[1], partition_filter['count'] / float(PARTITIONS))
+            estimate['seed'] = seed
+            return {'records': filtered_records, 'estimate': estimate}
         return filtered_records
 
     def _save_records(self, records, append_mode):
@@ -176,13 +342,16 @@ class ObjectManager(object):
             else:
                 raise AssertionError('Invalid file save_format: {}'.format(self._save_format))
 
-    def _is_valid_record(self, record):
+    def _is_valid_record(self, record, filter_kwargs=None):
         if not record[2]:
             return False
 
+        if filter_kwargs is None:
+            filter_kwargs = self._filter_kwargs
+
         filter_success = True
-        if self._filter_kwargs:
-            filter_success = self._is_valid_record_wrapper(self._filter_kwargs, record[2])
+        if filter_kwargs:
+            filter_success = self._is_valid_record_wrapper(filter_kwargs, record[2])
 
         exclude_success = True
         if self._exclude_kwargs:
@@ -246,7 +415,7 @@ class ObjectManager(object):
                     nested_filter = {
                         nested_filter_key: filter_value
                     }
-                    is_valid = self._is_valid_record(nested_filter, value)
+                    is_valid = self._is_valid_record_wrapper(nested_filter, value)
                 else:
                     raise AssertionError('Invalid filter: {}'.format('__'.join(filter_key)))
 
@@ -255,26 +424,33 @@ class ObjectManager(object):
 
         return is_valid
 
-    def _scan_callback(self, records, max_records_count=20, max_scans_count=100000):
+    def _scan_callback(self, records, max_records_count=20, max_scans_count=100000, current_count=None,
+                       count_all=False, filter_kwargs=None):
         # integers are immutable so a list (mutable) is used for the counter
+        # [scanned, found], with count_all scan continues past max_records_count
+        # to count all the matching records
         total_records = self.get_total_objects()
-        current_count = [0, 0]
+        if current_count is None:
+            current_count = [0, 0]
+        progress = LogThrottle()
 
         def wrapper(record):
             try:
                 if max_scans_count != -1 and current_count[0] >= max_scans_count:
                     return False
-                elif max_records_count != -1 and current_count[1] >= max_records_count:
+                elif not count_all and max_records_count != -1 and current_count[1] >= max_records_count:
                     return False
 
-                if self._is_valid_record(record):
-                    bins = self._get_bins(self._select_keys, record)
-                    records.append(bins)
+                if self._is_valid_record(record, filter_kwargs):
+                    if max_records_count == -1 or current_count[1] < max_records_count:
+                        records.append(self._get_record(record))
                     current_count[1] += 1
 
                 current_count[0] += 1
+                if current_count[0] % 1000 == 0:
+                    if progress.due():
+                        logger.info('Total Records: %s/rf, Total Scanned: %s, Records Found: %s', total_records, current_count[0], current_count[1])
                 if current_count[0] % 50000 == 0:
-                    logger.info('Total Records: %s/rf, Total Scanned: %s, Records Found: %s', total_records, current_count[0], current_count[1])
                     if self._save_file:
                         self._save_records(records, True)
                         records[:] = []  # clear
@@ -286,6 +462,161 @@ class ObjectManager(object):
 
         return wrapper
 
+    def _execute_plan(self, plan, callback_args, scan_policy, scan_option):
+        logger.info('Plan: %s', plan)
+        if plan['type'] == 'query':
+            scanner = self.connection.query(self.namespace, self.set)
+            scanner.where(getattr(predicates, plan['predicate'])(plan['bin'], *plan['args']))
+        else:
+            scanner = self.connection.scan(self.namespace, self.set)
+
+        query_bins = self._query_bins()
+        if query_bins:
+            scanner.select(*list(query_bins))
+
+        callback = self._scan_callback(*callback_args, filter_kwargs=plan['residual_filters'])
+        if plan['type'] == 'query':
+            # scan options (priority, concurrent) don't apply to queries
+            scanner.foreach(callback, policy=scan_policy or None)
+        else:
+            scanner.foreach(callback, policy=scan_policy or None, options=scan_option)
+
+    def explain(self, use_index=True):
+        """
+        Returns the plan scan() would use for the current filters:
+            type: 'query' (secondary index) or 'scan' (full set scan)
+            index, bin, predicate, args: the index and aerospike predicate used by a query
+            residual_filters: filters applied on the returned records
+        """
+        return self._plan(use_index)
+
+    def _plan(self, use_index=True):
+        plan = {
+            'type': 'scan',
+            'namespace': self.namespace,
+            'set': self.set,
+            'residual_filters': dict(self._filter_kwargs),
+            'exclude': dict(self._exclude_kwargs),
+        }
+        if not use_index or not self._filter_kwargs:
+            return plan
+
+        sindexes = self._get_sindexes()
+
+        # equality filters and integer bounds per bin, nested keys are not indexed
+        equals = {}
+        ranges = {}
+        for filter_key, filter_value in self._filter_kwargs.items():
+            key_split = filter_key.split('__')
+            if len(key_split) > 2 or key_split[0] not in sindexes:
+                continue
+
+            if len(key_split) == 1:
+                if isinstance(filter_value, (int, str)) and not isinstance(filter_value, bool):
+                    equals[key_split[0]] = filter_key
+            elif key_split[1] in ('gt', 'gte', 'lt', 'lte'):
+                if isinstance(filter_value, int) and not isinstance(filter_value, bool):
+                    ranges.setdefault(key_split[0], []).append(filter_key)
+
+        candidate = None
+        for bin_name, filter_key in sorted(equals.items()):
+            value = self._filter_kwargs[filter_key]
+            index_type = 'NUMERIC' if isinstance(value, int) else 'STRING'
+            if sindexes[bin_name].get(index_type):
+                candidate = (bin_name, index_type, 'equals', [value], [filter_key])
+                break
+
+        if candidate is None:
+            for bin_name, filter_keys in sorted(ranges.items()):
+                if not sindexes[bin_name].get('NUMERIC'):
+                    continue
+
+                low, high = INT64_MIN, INT64_MAX
+                for filter_key in filter_keys:
+                    value = self._filter_kwargs[filter_key]
+                    op = filter_key.split('__')[1]
+                    if op == 'gt':
+                        low = max(low, value + 1)
+                    elif op == 'gte':
+                        low = max(low, value)
+                    elif op == 'lt':
+                        high = min(high, value - 1)
+                    else:
+                        high = min(high, value)
+                # contradictory bounds match nothing, leave them to the residual filters
+                if low > high:
+                    continue
+
+                candidate = (bin_name, 'NUMERIC', 'between', [low, high], filter_keys)
+                break
+
+        if candidate is None:
+            return plan
+
+        bin_name, index_type, predicate, args, used_keys = candidate
+        plan.update({
+            'type': 'query',
+            'index': sindexes[bin_name][index_type],
+            'bin': bin_name,
+            'predicate': predicate,
+            'args': args,
+        })
+        for filter_key in used_keys:
+            del plan['residual_filters'][filter_key]
+        return plan
+
+    def _get_sindexes(self):
+        """
+        Returns {bin: {'NUMERIC'|'STRING': index name}} of the secondary
+        indexes on this namespace/set, cached for SINDEX_CACHE_TTL seconds
+        """
+        cache_key = (id(self.connection), self.namespace)
+        cached = _sindex_cache.get(cache_key)
+        if cached is None or time.time() - cached[0] > SINDEX_CACHE_TTL:
+            cached = (time.time(), self._load_sindexes())
+            _sindex_cache[cache_key] = cached
+
+        sindexes = {}
+        for index in cached[1]:
+            # an index without set covers the whole namespace
+            if index['set'] not in (None, self.set) or index['state'] != 'RW':
+                continue
+            sindexes.setdefault(index['bin'], {})[index['type']] = index['name']
+        return sindexes
+
+    def _load_sindexes(self):
+        # info format (one index per ';'):
+        # ns=test:set=demo:indexname=idx_age:num_bins=1:bins=age:type=NUMERIC:indextype=NONE:path=age:state=RW
+        # newer servers use bin= instead of bins= and lower case types
+        indexes = {}
+        for cluster_id, info in self.connection.info('sindex').items():
+            if info[0] or not info[1]:
+                continue
+
+            for entry in info[1].strip().split(';'):
+                fields = dict(
+                    field.split('=', 1) for field in entry.strip().split(':') if '=' in field
+                )
+                if fields.get('ns') != self.namespace or fields.get('indextype', 'NONE').upper() not in ('NONE', 'DEFAULT'):
+                    continue
+
+                bin_name = fields.get('bins', fields.get('bin'))
+                # indexes on map/list elements can't serve bin filters
+                if fields.get('context', 'NULL') != 'NULL' or fields.get('path', bin_name) != bin_name:
+                    continue
+
+                set_name = fields.get('set')
+                indexes[fields.get('indexname')] = {
+                    'name': fields.get('indexname'),
+                    'set': None if set_name in (None, '', 'NULL') else set_name,
+                    'bin': bin_name,
+                    'type': fields.get('type', '').upper(),
+                    'state': fields.get('state', 'RW'),
+                }
+
+        logger.info('Secondary indexes on %s: %s', self.namespace, sorted(indexes))
+        return list(indexes.values())
+
     def get_total_objects(self):
         clusters_info = self.connection.info('sets')
 
@@ -301,6 +632,35 @@ class ObjectManager(object):
             raise AssertionError('Invalid namespace-set or no records found')
         return objects_count
 
+    def _set_compact(self, compact):
+        if compact and self._save_file:
+            raise AssertionError('compact results can not be used with save_file')
+        if compact and not self._select_keys:
+            raise AssertionError('select attribute is required for compact results')
+        self._compact = compact
+
+    def _new_records(self):
+        return ResultSet(self._select_keys) if self._compact else []
+
+    def _get_record(self, record):
+        if self._compact:
+            return self._get_row(record)
+        return self._get_bins(self._select_keys, record)
+
+    def _get_row(self, record):
+        # values of the selected keys in order, without building a dict per record
+        # (nested keys go through _get_bins)
+        bins = record[2]
+        row = []
+        for key in self._select_keys:
+            if key == 'pk':
+                row.append(record[0][3])
+            elif '__' in key:
+                row.append(self._get_bins([key], record))
+            else:
+                row.append(bins.get(key))
+        return tuple(row)
+
     def _get_bins(self, select_keys, record):
 
         if not select_keys:
@@ -0,0 +1,335 @@
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import shutil
+import argparse
+import threading
+import traceback
+from multiprocessing import Pool
+
+
+# keys of the dump config forwarded to the shard workers, everything else
+# (imports, helpers) defined in the config file is dropped as it may not be
+# picklable
+SETTINGS_KEYS = [
+    'hosts', 'namespace', 'set', 'index', 'select', 'filter', 'exclude',
+    'save_format', 'log_path', 'adaptive'
+]
+
+# seconds between two live progress reports
+PROGRESS_INTERVAL = 10
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', required=True)
+    parser.add_argument('--shards', type=int, help='number of shards, default: workers')
+    parser.add_argument('--workers', type=int, help='number of parallel worker processes, default: 1')
+    parser.add_argument('--records-per-second', type=int,
+                        help='total throughput limit across all workers, default: unlimited')
+    parser.add_argument('--no-merge', action='store_true',
+                        help='keep per shard files and only write the manifest')
+    return parser
+
+
+def load_options(settings, args):
+    """
+    Combines the dump config with command line overrides
+    """
+    options = {
+        'workers': args.workers or settings.get('workers', 1),
+        'records_per_second': args.records_per_second or settings.get('records_per_second'),
+        'merge': settings.get('merge', True) and not args.no_merge,
+    }
+    options['shards'] = args.shards or settings.get('shards') or options['workers']
+
+    if options['workers'] < 1 or options['shards'] < 1:
+        raise AssertionError('workers and shards should be greater than 0')
+    return options
+
+
+def _read_pks(pk_file):
+    with open(pk_file) as f:
+        for line in f:
+            # Accepted pk format: any string with ['alphabets', '.', '@', '-']
+            for pk in re.findall(r'[\w@.-]+', line):
+                yield pk
+
+
+def split_pk_file(pk_file, shards, shard_dir):
+    """
+    Splits the pks of pk_file in `shards` contiguous ranges, so merging the
+    shard outputs in order keeps the order of pk_file. Returns the list of
+    shard pk files
+    """
+    total = sum(1 for _ in _read_pks(pk_file))
+    paths = [os.path.join(shard_dir, 'pks-{:05d}.txt'.format(i)) for i in range(shards)]
+
+    pks = _read_pks(pk_file)
+    for i, path in enumerate(paths):
+        count = (i + 1) * total // shards - i * total // shards
+        with open(path, 'w') as f:
+            for _ in range(count):
+                f.write(next(pks) + '\n')
+    return paths
+
+
+def partition_filters(shards, partitions):
+    """
+    Splits `partitions` in `shards` contiguous ranges
+    """
+    filters = []
+    for i in range(shards):
+        begin = i * partitions // shards
+        end = (i + 1) * partitions // shards
+        filters.append({'begin': begin, 'count': end - begin})
+    return filters
+
+
+def build_tasks(settings, options, max_scan_shards=None):
+    """
+    Creates one task per shard, a shard is either a part of the pk file or a
+    part of the full scan (at most max_scan_shards parts)
+    """
+    if not settings.get('pk_file') and max_scan_shards and options['shards'] > max_scan_shards:
+        raise AssertionError('shards should be at most {} for scan dumps'.format(max_scan_shards))
+
+    save_file = settings['save_file']
+    save_format = settings.get('save_format', 'json')
+    shard_dir = save_file + '.shards'
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    shards = options['shards']
+    rate = options['records_per_second']
+    worker_settings = dict((k, settings[k]) for k in SETTINGS_KEYS if k in settings)
+
+    # settings are sent to the worker processes, fail before starting any shard
+    if options['workers'] > 1:
+        try:
+            pickle.dumps(worker_settings)
+        except Exception as e:
+            raise AssertionError('filter/exclude values should be picklable with workers > 1, callable '
+                                 'filters have to be imported from a module, not defined in the config ({})'.format(e))
+
+    pk_files = [None] * shards
+    if settings.get('pk_file'):
+        pk_files = split_pk_file(settings['pk_file'], shards, shard_dir)
+
+    tasks = []
+    for i in range(shards):
+        tasks.append({
+            'shard': i,
+            'shards': shards,
+            'settings': worker_settings,
+            'pk_file': pk_files[i],
+            'save_file': os.path.join(shard_dir, 'part-{:05d}.{}'.format(i, save_format)),
+            # each worker gets an equal share of the total throughput
+            'records_per_second': rate and max(1, rate // min(options['workers'], shards)),
+        })
+    return tasks
+
+
+def count_records(save_file, save_format):
+    if not os.path.exists(save_file):
+        return 0
+
+    with open(save_file) as f:
+        count = sum(1 for _ in f)
+
+    if save_format == 'csv' and count:
+        count -= 1  # header
+    return count
+
+
+def run_shard(dump_shard, task):
+    """
+    Runs `dump_shard(task)` and reports the outcome, errors are returned
+    instead of raised so a failing shard doesn't abort the others.
+    dump_shard returns the adaptive batch stats of the shard, if any
+    """
+    start = time.time()
+    error = None
+    adaptive = None
+    try:
+        adaptive = dump_shard(task)
+    except Exception:
+        error = traceback.format_exc()
+
+    return {
+        'shard': task['shard'],
+        'pk_file': task['pk_file'],
+        'save_file': task['save_file'],
+        'records': count_records(task['save_file'], task['settings'].get('save_format', 'json')),
+        'elapsed': round(time.time() - start, 3),
+        'error': error,
+        'adaptive': adaptive,
+    }
+
+
+class _ShardRunner(object):
+    # picklable callable for Pool.imap_unordered
+    def __init__(self, dump_shard):
+        self.dump_shard = dump_shard
+
+    def __call__(self, task):
+        return run_shard(self.dump_shard, task)
+
+
+def merge_shards(results, save_file, save_format):
+    with open(save_file, 'w') as out:
+        write_header = True
+        for result in sorted(results, key=lambda r: r['shard']):
+            if not os.path.exists(result['save_file']):
+                continue
+            with open(result['save_file']) as f:
+                if save_format == 'csv' and not write_header:
+                    f.readline()
+                shutil.copyfileobj(f, out)
+            write_header = False
+
+
+def write_manifest(path, summary, results):
+    with open(path, 'w') as f:
+        json.dump({
+            'summary': summary,
+            'shards': sorted(results, key=lambda r: r['shard'])
+        }, f, indent=2)
+
+
+def report(done, total, records, errors, start, stream=sys.stderr):
+    elapsed = max(time.time() - start, 1e-6)
+    stream.write('[{}/{} shards] records: {}, records/sec: {:.0f}, errors: {}, elapsed: {:.1f}s\n'.format(
+        done, total, records, records / elapsed, errors, elapsed))
+    stream.flush()
+
+
+class ProgressReporter(threading.Thread):
+    """
+    Reports the records written so far every `interval` seconds while the
+    shards run, only the bytes appended to the shard files since the last
+    poll are read to count the new lines
+    """
+
+    def __init__(self, tasks, save_format, start, interval=PROGRESS_INTERVAL):
+        super(ProgressReporter, self).__init__()
+        self.daemon = True
+        self.tasks = tasks
+        self.save_format = save_format
+        self.start_time = start
+        self.interval = interval
+        self.done = 0
+        self.errors = 0
+        self._offsets = {}
+        self._lines = {}
+        self._stop_event = threading.Event()
+
+    def records(self):
+        count = 0
+        for task in self.tasks:
+            path = task['save_file']
+            if not os.path.exists(path):
+                continue
+
+            with open(path, 'rb') as f:
+                f.seek(self._offsets.get(path, 0))
+                lines = self._lines.get(path, 0)
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    lines += chunk.count(b'\n')
+                self._offsets[path] = f.tell()
+                self._lines[path] = lines
+
+            if self.save_format == 'csv' and lines:
+                lines -= 1  # header
+            count += lines
+        return count
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            report(self.done, len(self.tasks), self.records(), self.errors, self.start_time)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def run(dump_shard, settings, options, max_scan_shards=None):
+    """
+    Dumps all the shards over a pool of `workers` processes, then merges the
+    shard files into settings['save_file'] (unless disabled) and writes
+    a manifest next to it.
+    Returns the run summary, summary['errors'] > 0 if any shard failed.
+    """
+    save_file = settings['save_file']
+    save_format = settings.get('save_format', 'json')
+    tasks = build_tasks(settings, options, max_scan_shards)
+
+    start = time.time()
+    results = []
+    records = 0
+    failed_records = 0
+    errors = 0
+
+    progress = ProgressReporter(tasks, save_format, start)
+    progress.start()
+
+    runner = _ShardRunner(dump_shard)
+    if options['workers'] == 1:
+        outcomes = (runner(task) for task in tasks)
+        pool = None
+    else:
+        pool = Pool(options['workers'])
+        outcomes = pool.imap_unordered(runner, tasks)
+
+    try:
+        for result in outcomes:
+            results.append(result)
+            if result['error']:
+                # lines written before the failure are not part of the dump
+                failed_records += result['records']
+                errors += 1
+                sys.stderr.write('shard {} failed:\n{}'.format(result['shard'], result['error']))
+            else:
+                records += result['records']
+            progress.done = len(results)
+            progress.errors = errors
+            report(len(results), len(tasks), records, errors, start)
+    finally:
+        progress.stop()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    elapsed = time.time() - start
+    summary = {
+        'shards': len(tasks),
+        'workers': options['workers'],
+        'records': records,
+        'failed_records': failed_records,
+        'errors': errors,
+        'elapsed': round(elapsed, 3),
+        'records_per_second': round(records / max(elapsed, 1e-6), 1),
+        'merged': False,
+    }
+
+    adaptive = [r['adaptive'] for r in results if r['adaptive']]
+    if adaptive:
+        summary['adaptive'] = dict(
+            (key, sum(stats[key] for stats in adaptive))
+            for key in ('requests', 'timeouts', 'rejections', 'increases', 'decreases')
+        )
+
+    # a partial result is never merged
+    if options['merge'] and not errors:
+        merge_shards(results, save_file, save_format)
+        shutil.rmtree(save_file + '.shards', ignore_errors=True)
+        for result in results:
+            result['save_file'] = save_file
+            result['pk_file'] = None
+        summary['merged'] = True
+
+    write_manifest(save_file + '.manifest.json', summary, results)
+    sys.stderr.write('Summary: {}\n'.format(json.dumps(summary)))
+    return summary
@@ -1,26 +1,46 @@
 import sys
-import argparse
 from runpy import run_path 
 
+from dbq import dump
 from dbq.es_query.client import Client
 
 
-def main(settings):
-    client = Client(hosts=settings['hosts'])
+def dump_shard(task):
+    settings = task['settings']
+    client = Client(hosts=settings['hosts'], log_path=settings.get('log_path'))
 
-    model = client.get_model(settings['index'])
-    model.objects\
-        .select(*settings['select'])\
-        .get(
-            pk_file=settings['pk_file'],
-            save_file=settings['save_file'],
-            save_format=settings.get('save_format', 'json')
+    objects = client.get_model(settings['index']).objects\
+        .filter(**settings.get('filter', {}))\
+        .exclude(**settings.get('exclude', {}))\
+        .select(*settings['select'])
+
+    if task['pk_file']:
+        objects.get(
+            pk_file=task['pk_file'],
+            save_file=task['save_file'],
+            save_format=settings.get('save_format', 'json'),
+            records_per_second=task['records_per_second'],
+            adaptive=settings.get('adaptive', False)
+        )
+        return objects.adaptive_stats
+    else:
+        objects.scan(
+            -1,
+            save_file=task['save_file'],
+            save_format=settings.get('save_format', 'json'),
+            records_per_second=task['records_per_second'],
+            # sliced scroll, a single slice is not allowed by elastic search
+            slice={'id': task['shard'], 'max': task['shards']} if task['shards'] > 1 else None
         )
 
 
+def main(settings, options):
+    summary = dump.run(dump_shard, settings, options)
+    return 1 if summary['errors'] else 0
+
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument('--config')
+    parser = dump.get_parser()
     args = parser.parse_args()
     settings = run_path(args.config)
-    main(settings)
+    sys.exit(main(settings, dump.load_options(settings, args)))
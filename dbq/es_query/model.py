@@ -1,21 +1,31 @@
 import csv
 import json
 import re
+import time
+import random
 import logging
 from datetime import datetime
 
 import aerospike
-from elasticsearch_dsl import Q, Search, query
+from elasticsearch_dsl import A, Q, SF, Search, query
+from elasticsearch.exceptions import ConnectionTimeout, TransportError
 from elasticsearch.helpers import ScanError
 
 from dateutil import parser as date_parser
 
+from dbq.utils import AdaptiveBatchSize, LogThrottle, RateLimiter, ResultSet, WatermarkStore, sample_estimate
+
 
 logger = logging.getLogger('es_query')
 
 
 class ObjectManager(object):
     max_chunk_size = 2000
+    # index.max_result_window, upper bound of a search without scroll
+    max_result_window = 10000
+    # bounds and target latency (in seconds) for get(adaptive=True)
+    adaptive_chunk_bounds = (200, max_result_window)
+    adaptive_target_latency = 1.0
 
     def __init__(self, connection, index):
         self.connection = connection
@@ -28,6 +38,16 @@ class ObjectManager(object):
         self._request_timeout = 10
         self._save_file = None
         self._save_format = None
+        self._slice = None
+        self._rate_limiter = RateLimiter()
+        self._chunk_size = self.max_chunk_size
+        self._adaptive = False
+        self._adaptive_chunk = None
+        self._watermark_store = None
+        self._timestamp_field = None
+        self._watermark = None
+        self._watermark_lag = 0
+        self._compact = False
 
     def filter(self, **kwargs):
         self._filter_kwargs = kwargs
@@ -41,6 +61,31 @@ class ObjectManager(object):
         self._should_kwargs = kwargs
         return self
 
+    @property
+    def adaptive_stats(self):
+        """
+        Current chunk size and counters of the adaptive controller (requests,
+        timeouts, rejections, increases, decreases, total_latency), None if
+        get(adaptive=True) was never called
+        """
+        if self._adaptive_chunk is None:
+            return None
+        return self._adaptive_chunk.to_dict()
+
+    def incremental(self, watermark_path, timestamp_field, lag=300):
+        """
+        Makes scan() return only the documents with timestamp_field greater
+        than the watermark, `lag` seconds before the start of the last
+        successful incremental scan of this index. The lag covers documents
+        which become searchable late (refresh interval, ingest lag, timestamps
+        set by the producers), they are returned again by the next run.
+        The watermark (epoch millis) is kept in watermark_path
+        """
+        self._watermark_store = WatermarkStore(watermark_path)
+        self._timestamp_field = timestamp_field
+        self._watermark_lag = lag
+        return self
+
     def select(self, *args):
         self._select_keys = args
         return self
@@ -50,11 +95,28 @@ class ObjectManager(object):
         self._sort_keys = args
         return self
 
-    def get(self, pks=None, pk_file=None, save_file=None, save_format='json', request_timeout=10):
+    def get(self, pks=None, pk_file=None, save_file=None, save_format='json', request_timeout=10,
+            records_per_second=None, adaptive=False, compact=False):
 
         self._request_timeout = request_timeout
         self._save_file = save_file
         self._save_format = save_format
+        self._set_compact(compact)
+        self._rate_limiter = RateLimiter(records_per_second)
+        self._adaptive = adaptive
+        if adaptive:
+            # kept across get() calls, the learned size carries over
+            if self._adaptive_chunk is None:
+                self._adaptive_chunk = AdaptiveBatchSize(
+                    self.max_chunk_size,
+                    *self.adaptive_chunk_bounds,
+                    target_latency=self.adaptive_target_latency,
+                    name='es_query chunk_size',
+                    logger=logger
+                )
+            self._chunk_size = self._adaptive_chunk.size
+        else:
+            self._chunk_size = self.max_chunk_size
 
         if pks and pk_file:
             raise AssertionError('Only one of pks or pk_file is required')
@@ -77,20 +139,48 @@ class ObjectManager(object):
             raise AssertionError('Atleast one of pks or pk_file is required')
 
     def _get_from_pks_list(self, pks):
-        keys = []
         if self._save_file:
+            # chunk size may change between chunks in adaptive mode
             i = 0
-            while True:
-                pk_chunk = pks[i * self.max_chunk_size :(i + 1) * self.max_chunk_size]
-                if not pk_chunk:
-                    break
-                self._filter_kwargs['_id__in'] = pk_chunk
-                self._scan_wrapper(self.max_chunk_size, True)
-                i += 1
+            while i < len(pks):
+                pk_chunk = pks[i:i + self._chunk_size]
+                self._get_chunk(pk_chunk)
+                i += len(pk_chunk)
             resp = None
         else:
-            self._filter_kwargs['_id__in'] = pks
-            resp = self._scan_wrapper(self.max_chunk_size, True)
+            resp = self._get_chunk(pks)
+        return resp
+
+    def _get_chunk(self, pks):
+        self._filter_kwargs['_id__in'] = pks
+        try:
+            start = time.time()
+            # a single search per chunk, the chunk size is what the controller adapts
+            resp = self._scan_wrapper(len(pks), True, scroll=False)
+        except (ConnectionTimeout, TransportError) as e:
+            if isinstance(e, ConnectionTimeout):
+                reason = 'timeout'
+            elif getattr(e, 'status_code', None) == 429:
+                reason = 'rejected'
+            else:
+                raise e
+
+            if not self._adaptive or not self._adaptive_chunk.failure(reason):
+                raise e
+
+            # retry the same pks split by the reduced chunk size
+            self._chunk_size = self._adaptive_chunk.size
+            resp = self._new_records()
+            i = 0
+            while i < len(pks):
+                pk_chunk = pks[i:i + self._chunk_size]
+                resp.extend(self._get_chunk(pk_chunk))
+                i += len(pk_chunk)
+            return resp
+
+        if self._adaptive:
+            self._adaptive_chunk.success(time.time() - start, len(pks))
+            self._chunk_size = self._adaptive_chunk.size
         return resp
 
     def _get_from_pk_file(self, pk_file):
@@ -104,7 +194,7 @@ class ObjectManager(object):
                     # Accepted pk format: any string with ['alphabets', '.', '@', '-']
                     for pk in re.findall(r'[\w@.-]+', line):
                         pks.append(pk)
-                        if len(pks) == self.max_chunk_size:
+                        if len(pks) >= self._chunk_size:
                             self._get_from_pks_list(pks)
                             pks = []
 
@@ -112,10 +202,22 @@ class ObjectManager(object):
                 if pks:
                     self._get_from_pks_list(pks)
 
-    def scan(self, max_records_count=20, save_file=None, save_format='json', request_timeout=10, clear_scroll=True):
+    def scan(self, max_records_count=20, save_file=None, save_format='json', request_timeout=10, clear_scroll=True,
+             records_per_second=None, slice=None, sample_percent=None, seed=None, compact=False):
+        # slice: {'id': n, 'max': total} to scroll only one slice of the index
+        # compact: return a dbq.utils.ResultSet of tuples instead of a list of dicts
         self._request_timeout = request_timeout
         self._save_file = save_file
         self._save_format = save_format
+        self._set_compact(compact)
+        self._rate_limiter = RateLimiter(records_per_second)
+        self._slice = slice
+
+        if self._watermark_store:
+            return self._incremental_scan(max_records_count, clear_scroll, sample_percent)
+
+        if sample_percent:
+            return self._sample_scan(max_records_count, sample_percent, seed)
 
         if (max_records_count > self.max_chunk_size or max_records_count == -1) and not self._save_file:
             raise AssertionError('save_file is required for \
@@ -125,19 +227,24 @@ class ObjectManager(object):
 
         return self._scan_wrapper(max_records_count, clear_scroll)
 
-    def _scan_wrapper(self, max_records_count, clear_scroll=True):
+    def _scan_wrapper(self, max_records_count, clear_scroll=True, scroll=True):
         search = self._get_search_obj(max_records_count)
 
-        if max_records_count > self.max_chunk_size or max_records_count == -1:
+        if scroll and (max_records_count > self.max_chunk_size or max_records_count == -1):
             try:
                 records = []
                 count = 0
+                progress = LogThrottle()
                 search = search.params(
                     size=self.max_chunk_size,
                     clear_scroll=clear_scroll,
                     scroll='5m'
                 )
                 for hit in search.scan():
+                    if count % self.max_chunk_size == 0:
+                        self._rate_limiter.acquire(self.max_chunk_size)
+                        if progress.due():
+                            logger.info('Index: %s, Records Scanned: %s', self.index, count)
                     records.append(self._parse_record(hit))
 
                     if self._save_file and len(records) == self.max_chunk_size:
@@ -154,26 +261,107 @@ class ObjectManager(object):
                 logger.exception(error)
                 raise error
         else:
+            self._rate_limiter.acquire(max_records_count)
             results = search.execute()
-            resp = []
+            resp = self._new_records()
             for hit in results.hits:
-                resp.append(self._parse_record(hit))
+                resp.append(self._get_record(hit))
             if self._save_file:
                 self._save_records(resp)
         return resp
 
+    def _incremental_scan(self, max_records_count, clear_scroll=True, sample_percent=None):
+        # the watermark can only advance once every changed document was scanned
+        if max_records_count != -1 or self._slice or sample_percent:
+            raise AssertionError('incremental scan requires a full scan: max_records_count=-1')
+        if not self._save_file:
+            raise AssertionError('save_file is required for incremental scan')
+
+        watermark_key = 'es:{}'.format(self.index)
+        # documents updated while scanning are picked again by the next run
+        next_watermark = int((time.time() - self._watermark_lag) * 1000)
+        self._watermark = self._watermark_store.get(watermark_key)
+        logger.info('Incremental scan of %s since %s', self.index, self._watermark)
+
+        self._save_records([], False)
+        try:
+            resp = self._scan_wrapper(max_records_count, clear_scroll)
+        finally:
+            self._watermark = None
+
+        self._watermark_store.set(watermark_key, next_watermark)
+        return resp
+
+    def _sample_scan(self, max_records_count, sample_percent, seed=None):
+        """
+        Scores every document with a seeded random_score in [0, 1) and keeps
+        the ones above 1 - sample_percent / 100. The filters are applied as
+        post_filter so a single request returns the sample size, the matching
+        count and up to max_records_count matching records
+        """
+        if not 0 < sample_percent <= 100:
+            raise AssertionError('sample_percent should be in (0, 100]')
+        if max_records_count == -1 or max_records_count > self.max_chunk_size:
+            raise AssertionError('max_records_count should be at most {} \
+                for sampling'.format(self.max_chunk_size))
+
+        if seed is None:
+            seed = random.randint(0, 2 ** 31 - 1)
+
+        if self._save_file:
+            self._save_records([], False)
+
+        filters = self._get_query()
+        sample_query = query.FunctionScore(
+            query=Q('match_all'),
+            functions=[SF('random_score', seed=seed, field='_seq_no')],
+            boost_mode='replace'
+        )
+        search = self._get_search_obj(max_records_count, sample_query)\
+            .post_filter(filters)\
+            .extra(min_score=1 - sample_percent / 100.0)
+        search.aggs.bucket('sampled', A('filter', Q('match_all')))
+        search.aggs.bucket('matched', A('filter', filters))
+
+        self._rate_limiter.acquire(max_records_count)
+        result = search.execute()
+
+        records = self._new_records()
+        for hit in result.hits:
+            records.append(self._get_record(hit))
+        if self._save_file:
+            self._save_records(records)
+            records = None
+
+        # aggregations run before post_filter, on the whole sample
+        estimate = sample_estimate(
+            result.aggregations.sampled.doc_count,
+            result.aggregations.matched.doc_count,
+            sample_percent / 100.0
+        )
+        estimate['seed'] = seed
+        return {'records': records, 'estimate': estimate}
+
     def count(self):
         search = self._get_search_obj(0)
         result = search.execute()
         return result.hits.total
 
-    def _get_search_obj(self, size=0):
-        _query = query.Bool(
-            must = self._build_query(self._filter_kwargs),
+    def _get_query(self):
+        must = self._build_query(self._filter_kwargs)
+        if self._watermark is not None:
+            must.append(Q('range', ** {self._timestamp_field: {'gt': self._watermark, 'format': 'epoch_millis'}}))
+
+        return query.Bool(
+            must = must,
             must_not = self._build_query(self._exclude_kwargs),
             should = self._build_query(self._should_kwargs)
         )
 
+    def _get_search_obj(self, size=0, _query=None):
+        if _query is None:
+            _query = self._get_query()
+
         search = Search(
             using = self.connection,
             index = self.index
@@ -184,7 +372,12 @@ class ObjectManager(object):
         .params(request_timeout=self._request_timeout)\
         .sort(*self._sort_keys)
 
-        logger.info(json.dumps(result.to_dict()))
+        if self._slice:
+            search = search.extra(slice=self._slice)
+
+        # built for every pk chunk, serialized only when debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(search.to_dict()))
         return search
 
     def _save_records(self, records, append_mode=True):
@@ -258,24 +451,45 @@ class ObjectManager(object):
 
         return query
 
+    def _set_compact(self, compact):
+        if compact and self._save_file:
+            raise AssertionError('compact results can not be used with save_file')
+        if compact and not self._select_keys:
+            raise AssertionError('select attribute is required for compact results')
+        self._compact = compact
+
+    def _new_records(self):
+        return ResultSet(self._select_keys) if self._compact else []
+
+    def _get_record(self, record):
+        if self._compact:
+            return self._parse_row(record)
+        return self._parse_record(record)
+
+    def _parse_row(self, record):
+        # values of the selected keys in order, the hit's source dict is read
+        # to pick them but only the tuple is kept
+        record_dict = record.to_dict()
+        row = []
+        for key in self._select_keys:
+            if key == 'pk':
+                row.append(record.meta['id'])
+                continue
+            key_split = key.split('__')
+            value = record_dict.get(key_split[0])
+            for split in key_split[1:]:
+                if isinstance(value, dict):
+                    value = value.get(split)
+            row.append(value)
+        return tuple(row)
+
     def _parse_record(self, record):
         # converting records to dict format from flat structure
         if not self._select_keys:
             resp = record.to_dict()
             resp['pk'] = record.meta['id']
         else:
-            resp = {}
-            record_dict = record.to_dict()
-            for key in self._select_keys:
-                if key == 'pk':
-                    resp['pk'] = record.meta['id']
-                    continue
-                key_split = key.split('__')
-                value = record_dict.get(key_split[0])
-                for split in key_split[1:]:
-                    if isinstance(value, dict):
-                        value = value.get(split)
-                resp[key] = value
+            resp = dict(zip(self._select_keys, self._parse_row(record)))
         return resp
 
 class ObjectModel(object):
@@ -1,7 +1,17 @@
 import os
+import re
+import json
+import time
+import math
+import queue
 import logging
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing.util import Finalize
+from collections import namedtuple
 from datetime import datetime
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 
 def date_filter(value):
@@ -21,28 +31,287 @@ def date_filter(value):
     return parsed_value
 
 
-def create_logger(name, log_path):
-    if not os.path.exists(log_path):
+class RateLimiter(object):
+    """
+    Paces callers so that at most `rate` units (records, requests) are
+    consumed per second. A rate of None or <= 0 disables throttling.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._next_at = 0
+
+    def acquire(self, units=1):
+        if not self.rate or self.rate <= 0:
+            return
+
+        now = time.time()
+        if self._next_at > now:
+            time.sleep(self._next_at - now)
+            now = self._next_at
+        self._next_at = now + units / float(self.rate)
+
+
+class AdaptiveBatchSize(object):
+    """
+    AIMD controller for batch/page sizes, the size grows while requests
+    complete well under target_latency, shrinks on slow requests and is
+    halved on timeouts or rejections, always within [minimum, maximum].
+    Decisions are logged and counted in `stats`.
+    """
+
+    def __init__(self, size, minimum, maximum, target_latency=1.0, name='batch_size', logger=None):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.size = min(max(size, minimum), maximum)
+        self.target_latency = target_latency
+        self.name = name
+        self.logger = logger or logging.getLogger('dbq')
+        self.stats = {
+            'requests': 0,
+            'timeouts': 0,
+            'rejections': 0,
+            'increases': 0,
+            'decreases': 0,
+            'total_latency': 0.0,
+        }
+
+    def success(self, latency, count=None):
+        """
+        Records a request of `count` items which took `latency` seconds,
+        requests smaller than half the current size (the leftover of a pk
+        file or shard) say nothing about the current size and don't resize
+        """
+        self.stats['requests'] += 1
+        self.stats['total_latency'] += latency
+
+        if count is not None and count < self.size // 2:
+            return
+
+        if latency < self.target_latency / 2:
+            self._resize(self.size * 1.5, 'latency {:.3f}s'.format(latency))
+        elif latency > self.target_latency:
+            self._resize(self.size * 0.75, 'latency {:.3f}s'.format(latency))
+
+    def to_dict(self):
+        return dict(self.stats, size=self.size)
+
+    def failure(self, reason):
+        """
+        Records a timeout ('timeout') or a rejection ('rejected') and halves the
+        size. Returns False if the size is already at its minimum, in which case
+        the caller should give up instead of retrying.
+        """
+        self.stats['requests'] += 1
+        self.stats['timeouts' if reason == 'timeout' else 'rejections'] += 1
+
+        if self.size <= self.minimum:
+            return False
+        self._resize(self.size // 2, reason)
+        return True
+
+    def _resize(self, size, reason):
+        size = int(min(max(size, self.minimum), self.maximum))
+        if size == self.size:
+            return
+
+        self.stats['increases' if size > self.size else 'decreases'] += 1
+        self.logger.info('Adaptive %s: %s -> %s (%s), stats: %s', self.name, self.size, size, reason, self.stats)
+        self.size = size
+
+
+def sample_estimate(scanned, matched, sample_fraction, z=1.96):
+    """
+    Estimates the full scan totals from a uniform sample that covered
+    `sample_fraction` of the records, bounds are the Wilson score interval
+    of the binomial proportion (z=1.96 for 95% confidence), which stays
+    meaningful when none or all of the sampled records matched
+    """
+    if scanned:
+        fraction = matched / float(scanned)
+        denominator = 1 + z ** 2 / scanned
+        center = (fraction + z ** 2 / (2.0 * scanned)) / denominator
+        half_width = z / denominator * math.sqrt(
+            fraction * (1 - fraction) / scanned + z ** 2 / (4.0 * scanned ** 2))
+        fraction_low = max(0.0, center - half_width)
+        fraction_high = min(1.0, center + half_width)
+    else:
+        fraction, fraction_low, fraction_high = 0.0, 0.0, 1.0
+
+    estimated_scanned = scanned / sample_fraction
+    return {
+        'sample_fraction': sample_fraction,
+        'scanned': scanned,
+        'matched': matched,
+        'fraction': fraction,
+        'fraction_low': fraction_low,
+        'fraction_high': fraction_high,
+        'estimated_records': int(round(estimated_scanned)),
+        'estimated_total': int(round(fraction * estimated_scanned)),
+        'estimated_total_low': int(math.floor(fraction_low * estimated_scanned)),
+        'estimated_total_high': int(math.ceil(fraction_high * estimated_scanned)),
+        'z': z,
+    }
+
+
+class WatermarkStore(object):
+    """
+    Persists one watermark per key (namespace/set or index) as a json file in
+    `path`. Watermarks are replaced atomically (temp file + rename), so a
+    failed run never leaves a partially written watermark behind.
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+
+    def _file(self, key):
+        return os.path.join(self.path, re.sub(r'[^\w.-]', '_', key) + '.json')
+
+    def get(self, key):
         try:
-            os.mkdir(log_path)
+            with open(self._file(key)) as f:
+                return json.load(f)['watermark']
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'key': key, 'watermark': value, 'updated_at': datetime.now().isoformat()}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self._file(key))
         except Exception:
-            raise AssertionError('Permission Denied: Please create logging folder {} \
-                and provide read/write access to it'.format(log_path))
+            os.remove(tmp_path)
+            raise
+
 
+class ResultSet(object):
+    """
+    Compact container for query results: every row is a plain tuple of the
+    selected values, the field names are kept once for the whole result set.
+    Rows are converted to namedtuples, dicts or a DataFrame only when read.
+    """
+
+    def __init__(self, fields):
+        if not fields:
+            raise AssertionError('select attribute is required for compact results')
+
+        self.fields = tuple(fields)
+        self.row_type = namedtuple('Row', self.fields, rename=True)
+        self._rows = []
+
+    def append(self, row):
+        self._rows.append(row)
+
+    def extend(self, rows):
+        self._rows.extend(rows._rows if isinstance(rows, ResultSet) else rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.row_type._make(row) for row in self._rows[index]]
+        return self.row_type._make(self._rows[index])
+
+    def __iter__(self):
+        make = self.row_type._make
+        for row in self._rows:
+            yield make(row)
+
+    def to_dicts(self):
+        fields = self.fields
+        for row in self._rows:
+            yield dict(zip(fields, row))
+
+    def to_dataframe(self):
+        try:
+            import pandas
+        except ImportError:
+            raise AssertionError('pandas is required for to_dataframe')
+        return pandas.DataFrame.from_records(self._rows, columns=self.fields)
+
+
+class LogThrottle(object):
+    """
+    Rate limits progress messages in record level loops: due() is True at
+    most once every `interval` seconds and only reads the clock otherwise
+    """
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self._last = 0
+
+    def due(self):
+        now = time.time()
+        if now - self._last < self.interval:
+            return False
+        self._last = now
+        return True
+
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+# name -> (pid, queue handler, listener) of the loggers set up by create_logger
+_log_listeners = {}
+_log_lock = threading.Lock()
+
+
+def create_logger(name, log_path):
+    """
+    Sets up `name` logger once per process: records are put on a queue by a
+    QueueHandler and written to the rotating file and console by a background
+    QueueListener, so logging calls don't wait on file I/O.
+    Child processes (dump workers) log to `<name>-<pid>.log`, as rotating a
+    file shared by several processes isn't safe
+    """
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
 
-    rotatingHandler = RotatingFileHandler(
-        os.path.join(log_path, name + '.log'),
-        maxBytes=1024,
-        backupCount=5
-    )
-    rotatingHandler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s :: %(module)s:%(lineno)d \nMessage:: %(message)s'))
+    with _log_lock:
+        configured = _log_listeners.get(name)
+        if configured and configured[0] == os.getpid():
+            return logger
+        elif configured:
+            # inherited through fork, the listener thread doesn't exist in this process
+            logger.removeHandler(configured[1])
+
+        if not os.path.exists(log_path):
+            try:
+                os.makedirs(log_path)
+            except Exception:
+                raise AssertionError('Permission Denied: Please create logging folder {} \
+                    and provide read/write access to it'.format(log_path))
+
+        logger.setLevel(logging.INFO)
+
+        log_file = name + '.log'
+        if multiprocessing.current_process().name != 'MainProcess':
+            log_file = '{}-{}.log'.format(name, os.getpid())
+
+        rotatingHandler = RotatingFileHandler(
+            os.path.join(log_path, log_file),
+            maxBytes=LOG_MAX_BYTES,
+            backupCount=LOG_BACKUP_COUNT
+        )
+        rotatingHandler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s :: %(module)s:%(lineno)d \nMessage:: %(message)s'))
+
+        consoleHandler = logging.StreamHandler()
+        consoleHandler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s :: %(message)s'))
 
-    consoleHandler = logging.StreamHandler()
-    consoleHandler.setFormatter(logging.Formatter('[%(levelname)s] %(asctime)s :: %(message)s'))
+        log_queue = queue.Queue(-1)
+        queueHandler = QueueHandler(log_queue)
+        listener = QueueListener(log_queue, rotatingHandler, consoleHandler, respect_handler_level=True)
+        listener.start()
+        # flush the queue on exit, unlike atexit also run by multiprocessing
+        # workers which exit with os._exit
+        Finalize(listener, listener.stop, exitpriority=10)
 
-    logger.addHandler(rotatingHandler)
-    logger.addHandler(consoleHandler)
+        logger.addHandler(queueHandler)
+        _log_listeners[name] = (os.getpid(), queueHandler, listener)
 
     return logger
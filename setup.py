@@ -12,7 +12,7 @@ setup(
 	author='Pankaj Saini',
 	author_email='pankaj.saini@airtel.com',
 	packages=find_packages(),
-	python_requires=">=2.7",
+	python_requires=">=3.6",
 	install_requires=[
 		"aerospike",
 		"elasticsearch-dsl",
@@ -0,0 +1,56 @@
+import pytest
+
+pytest.importorskip('aerospike')
+pytest.importorskip('elasticsearch_dsl')
+
+from dbq.as_query import model
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class SlowConnection(object):
+    """
+    Batch latency grows with the number of keys, 5000 keys take 1.5s
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.batches = []
+
+    def get_many(self, keys, policy):
+        self.batches.append(len(keys))
+        self.clock.now += 0.0003 * len(keys)
+        return [(key + (None,), {}, {'bin': key[2]}) for key in keys]
+
+
+def test_adaptive_get_from_pk_file_shrinks_slow_batches(tmpdir, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(model, 'time', clock)
+    connection = SlowConnection(clock)
+
+    pk_file = tmpdir.join('pks.txt')
+    pk_file.write('\n'.join(str(i) for i in range(30000)))
+
+    model.ObjectManager(connection, 'ns', 'set').get(
+        pk_file=str(pk_file),
+        save_file=str(tmpdir.join('out.json')),
+        adaptive=True
+    )
+
+    # no 1-key leftovers and the size never grows while batches are slow
+    assert connection.batches[0] == 5000
+    assert min(connection.batches[:-1]) > 1
+    for previous, current in zip(connection.batches[:-2], connection.batches[1:-1]):
+        assert current <= previous
+    assert sum(connection.batches) == 30000
+
+
+def test_sample_scan_requires_save_file_for_all_records():
+    with pytest.raises(AssertionError):
+        model.ObjectManager(None, 'ns', 'set').scan(-1, sample_percent=100)
@@ -0,0 +1,117 @@
+import pytest
+
+pytest.importorskip('aerospike')
+pytest.importorskip('elasticsearch_dsl')
+
+from dbq.as_query import model
+
+
+# old info format: bins=, upper case types
+OLD_FORMAT = (
+    'ns=optimus:set=arch_dsi:indexname=idx_age:num_bins=1:bins=age:type=NUMERIC:indextype=NONE:path=age:state=RW;'
+    'ns=optimus:set=arch_dsi:indexname=idx_cat:num_bins=1:bins=cust_cat:type=STRING:indextype=NONE:path=cust_cat:state=RW;'
+    'ns=other:set=arch_dsi:indexname=idx_other:num_bins=1:bins=seg:type=STRING:indextype=NONE:path=seg:state=RW;'
+)
+
+# new info format: bin=, lower case types, set-less and context indexes
+NEW_FORMAT = (
+    'ns=optimus:indexname=idx_code:set=arch_dsi:bin=code:type=numeric:indextype=default:context=NULL:state=RW;'
+    'ns=optimus:indexname=idx_code_str:set=arch_dsi:bin=code:type=string:indextype=default:context=NULL:state=RW;'
+    'ns=optimus:indexname=idx_seg:set=NULL:bin=seg:type=string:indextype=default:context=NULL:state=RW;'
+    'ns=optimus:indexname=idx_map:set=arch_dsi:bin=addr:type=string:indextype=default:context=kAAB:state=RW;'
+    'ns=optimus:indexname=idx_other_set:set=other:bin=city:type=string:indextype=default:context=NULL:state=RW;'
+)
+
+
+class FakeConnection(object):
+    def __init__(self, sindex_info):
+        self.sindex_info = sindex_info
+
+    def info(self, command):
+        assert command == 'sindex'
+        return {'node1': (None, self.sindex_info)}
+
+
+@pytest.fixture(autouse=True)
+def clear_sindex_cache():
+    model._sindex_cache.clear()
+    yield
+    model._sindex_cache.clear()
+
+
+def objects(sindex_info=OLD_FORMAT):
+    return model.ObjectManager(FakeConnection(sindex_info), 'optimus', 'arch_dsi')
+
+
+def test_equality_on_string_index():
+    plan = objects().filter(cust_cat='M2M', cust_seg='Gold').explain()
+
+    assert plan['type'] == 'query'
+    assert plan['index'] == 'idx_cat'
+    assert (plan['predicate'], plan['args']) == ('equals', ['M2M'])
+    assert plan['residual_filters'] == {'cust_seg': 'Gold'}
+
+
+def test_range_bounds_are_merged():
+    plan = objects().filter(age__gt=10, age__lte=20, age__gte=5).explain()
+
+    assert plan['type'] == 'query'
+    assert (plan['predicate'], plan['args']) == ('between', [11, 20])
+    assert plan['residual_filters'] == {}
+
+
+def test_open_range_uses_int64_bounds():
+    plan = objects().filter(age__lt=5).explain()
+
+    assert plan['args'] == [model.INT64_MIN, 4]
+
+
+def test_contradictory_range_falls_back_to_scan():
+    plan = objects().filter(age__gt=10, age__lt=5).explain()
+
+    assert plan['type'] == 'scan'
+    assert plan['residual_filters'] == {'age__gt': 10, 'age__lt': 5}
+
+
+def test_equality_preferred_over_range():
+    plan = objects().filter(age__gt=10, cust_cat='M2M').explain()
+
+    assert plan['bin'] == 'cust_cat'
+    assert plan['residual_filters'] == {'age__gt': 10}
+
+
+def test_bool_and_unindexed_filters_scan():
+    assert objects().filter(age=True).explain()['type'] == 'scan'
+    assert objects().filter(age__gt=True).explain()['type'] == 'scan'
+    assert objects().filter(si='1').explain()['type'] == 'scan'
+    assert objects().filter(cust_cat__icontains='m2m').explain()['type'] == 'scan'
+
+
+def test_value_type_picks_index_type():
+    # a string value can't use the numeric index on age
+    assert objects().filter(age='10').explain()['type'] == 'scan'
+
+    manager = objects(NEW_FORMAT)
+    assert manager.filter(code=10).explain()['index'] == 'idx_code'
+    assert manager.filter(code='10').explain()['index'] == 'idx_code_str'
+
+
+def test_new_info_format():
+    manager = objects(NEW_FORMAT)
+
+    # set-less index covers the set
+    assert manager.filter(seg='Gold').explain()['index'] == 'idx_seg'
+    # index on a map context or on another set is not used
+    assert manager.filter(addr='x').explain()['type'] == 'scan'
+    assert manager.filter(city='x').explain()['type'] == 'scan'
+
+
+def test_index_of_other_namespace_is_ignored():
+    assert objects().filter(seg='Gold').explain()['type'] == 'scan'
+
+
+def test_use_index_false_scans():
+    plan = objects().filter(cust_cat='M2M').explain(use_index=False)
+
+    assert plan['type'] == 'scan'
+    assert plan['residual_filters'] == {'cust_cat': 'M2M'}
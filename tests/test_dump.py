@@ -0,0 +1,105 @@
+import os
+import json
+
+import pytest
+
+# importing dbq loads both clients
+pytest.importorskip('aerospike')
+pytest.importorskip('elasticsearch_dsl')
+
+from dbq import dump
+
+
+def _options(**kwargs):
+    options = {'workers': 1, 'shards': 1, 'records_per_second': None, 'merge': True}
+    options.update(kwargs)
+    return options
+
+
+def test_split_pk_file_keeps_order(tmpdir):
+    pk_file = tmpdir.join('pks.txt')
+    pk_file.write('\n'.join(str(i) for i in range(10)))
+
+    paths = dump.split_pk_file(str(pk_file), 3, str(tmpdir))
+
+    shards = [open(path).read().split() for path in paths]
+    assert shards == [['0', '1', '2'], ['3', '4', '5'], ['6', '7', '8', '9']]
+
+
+def test_split_pk_file_more_shards_than_pks(tmpdir):
+    pk_file = tmpdir.join('pks.txt')
+    pk_file.write('a,b')
+
+    paths = dump.split_pk_file(str(pk_file), 4, str(tmpdir))
+
+    assert [open(path).read().split() for path in paths] == [[], ['a'], [], ['b']]
+
+
+def test_partition_filters_cover_all_partitions():
+    filters = dump.partition_filters(3, 4096)
+
+    assert filters[0]['begin'] == 0
+    assert sum(f['count'] for f in filters) == 4096
+    for previous, current in zip(filters, filters[1:]):
+        assert current['begin'] == previous['begin'] + previous['count']
+
+
+def test_build_tasks_rejects_too_many_scan_shards(tmpdir):
+    settings = {'save_file': str(tmpdir.join('out.json'))}
+
+    with pytest.raises(AssertionError):
+        dump.build_tasks(settings, _options(shards=4097), max_scan_shards=4096)
+
+
+def test_build_tasks_rejects_unpicklable_filters(tmpdir):
+    settings = {'save_file': str(tmpdir.join('out.json')), 'filter': {'a': lambda x: True}}
+
+    with pytest.raises(AssertionError):
+        dump.build_tasks(settings, _options(workers=2, shards=2))
+
+
+def test_merge_shards_writes_csv_header_once(tmpdir):
+    results = []
+    for i in range(2):
+        part = tmpdir.join('part-{}.csv'.format(i))
+        part.write('pk\n{}\n'.format(i))
+        results.append({'shard': i, 'save_file': str(part)})
+    save_file = tmpdir.join('out.csv')
+
+    dump.merge_shards(list(reversed(results)), str(save_file), 'csv')
+
+    assert save_file.read() == 'pk\n0\n1\n'
+
+
+def _dump_shard(task):
+    with open(task['save_file'], 'w') as f:
+        for pk in open(task['pk_file']).read().split():
+            f.write('{"pk": "%s"}\n' % pk)
+    if task['shard'] == 1:
+        raise ValueError('shard failed')
+
+
+def test_run_counts_only_successful_shards(tmpdir):
+    pk_file = tmpdir.join('pks.txt')
+    pk_file.write('\n'.join(str(i) for i in range(6)))
+    settings = {'save_file': str(tmpdir.join('out.json')), 'pk_file': str(pk_file)}
+
+    summary = dump.run(_dump_shard, settings, _options(shards=3))
+
+    assert summary['records'] == 4
+    assert summary['failed_records'] == 2
+    assert summary['errors'] == 1
+    assert not summary['merged']
+    assert os.path.exists(settings['save_file'] + '.manifest.json')
+
+
+def test_run_merges_in_pk_file_order(tmpdir):
+    pk_file = tmpdir.join('pks.txt')
+    pk_file.write('\n'.join(str(i) for i in range(10)))
+    settings = {'save_file': str(tmpdir.join('out.json')), 'pk_file': str(pk_file)}
+
+    summary = dump.run(lambda task: _dump_shard(dict(task, shard=0)), settings, _options(shards=4))
+
+    assert summary['merged']
+    with open(settings['save_file']) as f:
+        assert [json.loads(line)['pk'] for line in f] == [str(i) for i in range(10)]
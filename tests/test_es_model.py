@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip('aerospike')
+pytest.importorskip('elasticsearch_dsl')
+
+from dbq.es_query import model
+
+
+class FakeHit(object):
+    def __init__(self, id, source):
+        self.meta = {'id': id}
+        self._source = source
+
+    def to_dict(self):
+        return self._source
+
+
+def test_parse_record_and_row_share_the_selected_values():
+    objects = model.ObjectManager(None, 'optimus_si')\
+        .select('pk', 'cust_cat', 'res_addrss__pincode', 'missing__key')
+    hit = FakeHit('03340651199', {'cust_cat': 'M2M', 'res_addrss': {'pincode': '122001'}})
+
+    assert objects._parse_row(hit) == ('03340651199', 'M2M', '122001', None)
+    assert objects._parse_record(hit) == {
+        'pk': '03340651199', 'cust_cat': 'M2M', 'res_addrss__pincode': '122001', 'missing__key': None
+    }
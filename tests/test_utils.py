@@ -0,0 +1,82 @@
+import pytest
+
+# importing dbq loads both clients
+pytest.importorskip('aerospike')
+pytest.importorskip('elasticsearch_dsl')
+
+from dbq.utils import AdaptiveBatchSize, WatermarkStore, sample_estimate
+
+
+def test_adaptive_batch_size_aimd_sequence():
+    controller = AdaptiveBatchSize(1000, 100, 5000, target_latency=1.0)
+    sizes = []
+
+    controller.success(0.1)           # fast: x1.5
+    sizes.append(controller.size)
+    controller.success(0.7)           # within target: unchanged
+    sizes.append(controller.size)
+    controller.success(2.0)           # slow: x0.75
+    sizes.append(controller.size)
+    controller.failure('timeout')     # timeout: halved
+    sizes.append(controller.size)
+
+    assert sizes == [1500, 1500, 1125, 562]
+    assert controller.stats['increases'] == 1
+    assert controller.stats['decreases'] == 2
+    assert controller.stats['timeouts'] == 1
+
+
+def test_adaptive_batch_size_stays_within_bounds():
+    controller = AdaptiveBatchSize(1000, 100, 2000, target_latency=1.0)
+
+    for _ in range(10):
+        controller.success(0.01)
+    assert controller.size == 2000
+
+    while controller.failure('rejected'):
+        pass
+    assert controller.size == 100
+    assert controller.stats['rejections'] > 0
+
+
+def test_adaptive_batch_size_ignores_small_batches():
+    controller = AdaptiveBatchSize(1000, 100, 5000, target_latency=1.0)
+
+    controller.success(0.001, count=1)
+
+    assert controller.size == 1000
+    assert controller.stats['requests'] == 1
+
+
+def test_sample_estimate_scales_to_full_set():
+    estimate = sample_estimate(1000, 100, 0.01)
+
+    assert estimate['fraction'] == 0.1
+    assert estimate['estimated_records'] == 100000
+    assert estimate['estimated_total'] == 10000
+    assert estimate['estimated_total_low'] < 10000 < estimate['estimated_total_high']
+
+
+def test_sample_estimate_bounds_without_matches():
+    estimate = sample_estimate(100000, 0, 0.01)
+
+    assert estimate['estimated_total'] == 0
+    assert estimate['fraction_low'] == 0
+    # Wilson upper bound, not 0 like the normal approximation
+    assert 0 < estimate['fraction_high'] < 0.001
+    assert estimate['estimated_total_high'] > 0
+
+
+def test_watermark_store(tmpdir):
+    store = WatermarkStore(str(tmpdir.join('watermarks')))
+
+    assert store.get('as:optimus.arch_dsi') is None
+
+    store.set('as:optimus.arch_dsi', 100)
+    store.set('as:optimus.arch_dsi', 200)
+    store.set('es:optimus_si', 300)
+
+    assert store.get('as:optimus.arch_dsi') == 200
+    assert store.get('es:optimus_si') == 300
+    # no temp files left behind
+    assert len(tmpdir.join('watermarks').listdir()) == 2